@@ -1,24 +1,54 @@
 # ------ dependencies -----
-from flask import Flask, request, jsonify
+# gevent has to patch the stdlib before flask/pyairtable/requests are imported
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, request, g
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
-import json
+import atexit
 import logging
+import time
+import orjson
 from datetime import datetime
-from pyairtable import Api
+from pyairtable import Api, retry_strategy
+from cachetools import LRUCache, TTLCache
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+import redis
 import re
-import uuid
-import urllib.request
-import urllib.parse
+import secrets
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- Firebase imports ---
+# Firestore talks gRPC (a C extension), which needs its own gevent hook
+import grpc.experimental.gevent as grpc_gevent
+grpc_gevent.init_gevent()
 import firebase_admin
 from firebase_admin import credentials, firestore
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (verbose only in development)
+logging.basicConfig(level=logging.INFO if os.getenv("ENV") == "dev" else logging.WARNING)
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(DefaultJSONProvider):
+    # Anything Flask serialises itself (jsonify, request.get_json) goes through orjson too
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# USSD payloads are a few hundred bytes; refuse anything unreasonably large
+app.config["MAX_CONTENT_LENGTH"] = 8192
 
 # Environment variables
 AIRTABLE_PAT = os.getenv("AIRTABLE_PAT")
@@ -29,6 +59,11 @@ SUPPORT_PHONE = os.getenv("SUPPORT_PHONE")
 BULK_SMS_API_KEY = os.getenv("BULK_SMS_API_KEY")  #sms api (bulk sms ghana) 
 BULK_SMS_SENDER_ID = os.getenv("BULK_SMS_SENDER_ID")
 
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_TTL = int(os.getenv("SESSION_TTL", 300))  # seconds
+ORDER_HISTORY_TTL = int(os.getenv("ORDER_HISTORY_TTL", 30 * 24 * 3600))  # seconds; "My Orders" outlives the session
+MAX_MEMORY_SESSIONS = int(os.getenv("MAX_MEMORY_SESSIONS", 50000))
+
 # --- Firebase initialization ---
 FIREBASE_CREDENTIALS_JSON = os.getenv("FIREBASE_CREDENTIALS_JSON")
 firebase_db = None
@@ -45,23 +80,110 @@ if FIREBASE_CREDENTIALS_JSON:
     except Exception as e:
         logger.error(f"Firebase init error: {e}")
 
-def log_to_firebase(msisdn, userid, message, continue_session, state=None, session_id=None):
+def drain_batch(record_queue, batch_size, flush_interval):
+    # Block for the first record, then give the batch flush_interval seconds to fill up
+    records = [record_queue.get()]
+    deadline = time.monotonic() + flush_interval
+    while len(records) < batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            records.append(record_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return records
+
+# Put on a writer queue to tell its worker to finish up and exit
+QUEUE_STOP = object()
+
+def run_batch_writer(record_queue, batch_size, flush_interval, write_batch):
+    while True:
+        records = drain_batch(record_queue, batch_size, flush_interval)
+        stopping = any(record is QUEUE_STOP for record in records)
+        if stopping:
+            records = [record for record in records if record is not QUEUE_STOP]
+        if records:
+            write_batch(records)
+        if stopping:
+            return
+
+def flush_queue(record_queue, batch_size, write_batch):
+    # Write out whatever is still queued when the process exits
+    records = []
+    while True:
+        try:
+            record = record_queue.get_nowait()
+        except queue.Empty:
+            break
+        if record is not QUEUE_STOP:
+            records.append(record)
+    for i in range(0, len(records), batch_size):
+        write_batch(records[i:i + batch_size])
+
+def stop_batch_writer(worker, record_queue, batch_size, write_batch):
+    # Registered with atexit: the worker is a daemon thread, so let it finish the
+    # batch it is holding before the interpreter kills it, then write the rest
+    try:
+        record_queue.put(QUEUE_STOP, timeout=5)
+    except queue.Full:
+        pass
+    worker.join(timeout=30)
+    flush_queue(record_queue, batch_size, write_batch)
+
+# Firebase writes happen on a background thread so replies never wait on Firestore
+FIREBASE_BATCH_SIZE = 10
+FIREBASE_FLUSH_INTERVAL = 0.2  # seconds to wait for a batch to fill up
+firebase_log_queue = queue.Queue(maxsize=10000)
+firebase_log_dropped = 0
+
+def write_firebase_batch(records):
+    try:
+        collection = firebase_db.collection("ussd_responses")
+        batch = firebase_db.batch()
+        for record in records:
+            batch.set(collection.document(), record)
+        batch.commit()
+        logger.info("Logged %s rows to Firebase", len(records))
+    except Exception as e:
+        logger.error("Firebase log error: %s", e)
+
+def firebase_log_worker():
+    run_batch_writer(firebase_log_queue, FIREBASE_BATCH_SIZE, FIREBASE_FLUSH_INTERVAL, write_firebase_batch)
+
+if firebase_db:
+    firebase_log_thread = threading.Thread(target=firebase_log_worker, daemon=True)
+    firebase_log_thread.start()
+    atexit.register(stop_batch_writer, firebase_log_thread, firebase_log_queue, FIREBASE_BATCH_SIZE, write_firebase_batch)
+
+def log_to_firebase(msisdn, userid, message, response, continue_session, state=None, session_id=None):
+    # One row per USSD turn: M1 is what the user sent, M2 is what we replied
+    global firebase_log_dropped
     if not firebase_db:
         return
     try:
-        doc_ref = firebase_db.collection("ussd_responses").document()
-        doc_ref.set({
+        firebase_log_queue.put_nowait({
             "MSISDN": msisdn,
             "USERID": userid,
             "M1": message,
+            "M2": response,
             "ContinueSession": str(continue_session),
             "State": state or "unknown",
             "SessionID": session_id or "unknown",
             "Timestamp": get_airtable_datetime()
         })
-        logger.info(f"Logged to Firebase: {msisdn} - {message[:50]}...")
-    except Exception as e:
-        logger.error(f"Firebase log error: {e}")
+    except queue.Full:
+        firebase_log_dropped += 1
+        logger.warning("Firebase log queue full, dropped %s rows so far", firebase_log_dropped)
+
+# Shared HTTP session so outbound API calls reuse pooled keep-alive connections
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50, max_retries=Retry(total=0))
+http_session.mount("http://", http_adapter)
+http_session.mount("https://", http_adapter)
+
+SMS_API_URL = 'http://clientlogin.bulksmsgh.com/smsapi'
+SMS_TIMEOUT = (3, 5)  # (connect, read) seconds; keeps us inside the gateway's ~10s window
 
 def send_sms_ghana(phone_number, message):
     params = {
@@ -70,28 +192,132 @@ def send_sms_ghana(phone_number, message):
         'msg': message,
         'sender_id': BULK_SMS_SENDER_ID
     }
-    url = 'http://clientlogin.bulksmsgh.com/smsapi?' + urllib.parse.urlencode(params)
     try:
-        with urllib.request.urlopen(url) as response:
-            content = response.read().decode('utf-8')
-            code = content.strip()
-            logger.info(f"SMS API response: {code}")
-            return code == '1000'
+        response = http_session.get(SMS_API_URL, params=params, timeout=SMS_TIMEOUT)
+        response.raise_for_status()
+        code = response.text.strip()
+        logger.info("SMS API response: %s", code)
+        return code == '1000'
     except Exception as e:
-        logger.error(f"SMS sending failed: {e}")
+        logger.error("SMS sending failed: %s", e)
     return False
 
+# Confirmation SMS goes out in the background so the final screen isn't held up
+SMS_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sms")
+# Orders are already confirmed to the user, so send anything still queued before exiting
+atexit.register(SMS_EXECUTOR.shutdown, wait=True)
+
 # Airtable setup (orders only)
+AIRTABLE_TIMEOUT = (5, 20)  # (connect, read) seconds
 airtable_orders = None
 if AIRTABLE_PAT and AIRTABLE_BASE_ID:
     try:
-        api = Api(AIRTABLE_PAT)
+        # Rate-limit retries back off exponentially with jitter so the workers
+        # don't all hit Airtable again in lockstep. read=0: a POST that timed out may
+        # still have been stored, so only 429s and connect failures are retried
+        api = Api(
+            AIRTABLE_PAT,
+            timeout=AIRTABLE_TIMEOUT,
+            retry_strategy=retry_strategy(backoff_factor=0.5, backoff_jitter=0.5, backoff_max=30, read=0),
+        )
         base = api.base(AIRTABLE_BASE_ID)
         airtable_orders = base.table(AIRTABLE_ORDERS_TABLE)
         logger.info("Airtable connected for orders")
     except Exception as e:
         logger.error(f"Airtable failed: {e}")
 
+# Orders are written to Airtable in batches by a background thread
+AIRTABLE_BATCH_SIZE = 10  # Airtable's per-request record limit
+AIRTABLE_FLUSH_INTERVAL = 0.2
+airtable_order_queue = queue.Queue(maxsize=1000)
+
+def log_unsaved_airtable_order(record, error):
+    # Enough to re-enter the order by hand
+    logger.error(
+        "Airtable order log error: %s - %s: %s (record: %s)",
+        record.get("MSISDN"), record.get("OrderID"), error, orjson.dumps(record).decode()
+    )
+
+def write_airtable_batch(records):
+    try:
+        airtable_orders.batch_create(records)
+        logger.info("Logged %s orders to Airtable", len(records))
+        return
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else None
+        rejected = status is not None and 400 <= status < 500
+        error = e
+    except Exception as e:
+        rejected = False
+        error = e
+    if not rejected:
+        # Timeouts, dropped connections and 5xx may still have stored the batch, so
+        # re-posting could duplicate orders; log them for manual recovery instead
+        logger.error("Airtable order batch failed and may be partly stored: %s", error)
+        for record in records:
+            log_unsaved_airtable_order(record, error)
+        return
+    # Airtable refused the request outright (e.g. 422 from one bad record), so
+    # nothing was stored; write the orders one at a time so the rest still land
+    logger.error("Airtable rejected order batch: %s", error)
+    for record in records:
+        try:
+            airtable_orders.create(record)
+        except Exception as e:
+            log_unsaved_airtable_order(record, e)
+
+def airtable_order_worker():
+    run_batch_writer(airtable_order_queue, AIRTABLE_BATCH_SIZE, AIRTABLE_FLUSH_INTERVAL, write_airtable_batch)
+
+if airtable_orders:
+    airtable_order_thread = threading.Thread(target=airtable_order_worker, daemon=True)
+    airtable_order_thread.start()
+    atexit.register(stop_batch_writer, airtable_order_thread, airtable_order_queue, AIRTABLE_BATCH_SIZE, write_airtable_batch)
+
+# Redis setup (sessions shared across workers; falls back to memory)
+redis_client = None
+if REDIS_URL:
+    try:
+        # Bounded pool: with ~1000 greenlets per worker, callers wait for a free
+        # connection instead of opening one each
+        redis_pool = redis.BlockingConnectionPool.from_url(
+            REDIS_URL, max_connections=50, timeout=5, socket_keepalive=True
+        )
+        redis_client = redis.Redis(connection_pool=redis_pool)
+        redis_client.ping()
+        logger.info("Redis connected for sessions")
+    except Exception as e:
+        redis_client = None
+        logger.error("Redis failed: %s", e)
+
+def get_ussd_payload():
+    # Parsed once per request; shared by the rate limiter and ussd_handler
+    if "ussd_payload" not in g:
+        try:
+            raw = request.get_data(cache=False)
+            g.ussd_payload = orjson.loads(raw) if raw else None
+        except (orjson.JSONDecodeError, RequestEntityTooLarge):
+            g.ussd_payload = None
+    return g.ussd_payload
+
+def rate_limit_key():
+    # Every request comes from the USSD gateway's IP, so limit per caller instead
+    data = get_ussd_payload()
+    msisdn = data.get("MSISDN") if isinstance(data, dict) else None
+    return str(msisdn) if msisdn else get_remote_address()
+
+# Rate limiting (shares the session Redis when configured, so limits hold across workers)
+RATE_LIMITED_MSG = "Too many requests, try again shortly"
+if not REDIS_URL:
+    logger.warning("REDIS_URL not set: rate limits are kept per worker process, not shared")
+limiter = Limiter(
+    rate_limit_key,
+    app=app,
+    storage_uri=REDIS_URL or "memory://",
+    strategy="fixed-window",
+    swallow_errors=True
+)
+
 CATEGORIES = [
     "Chef One",
     "Eno's Kitchen",
@@ -124,6 +350,8 @@ CATEGORY_DELIVERY_FEES = {
 }
 DEFAULT_DELIVERY_FEE = 15
 GAS_DELIVERY_FEE = 30
+SERVICE_CHARGE = 4
+MAX_ORDER_HISTORY = 3  # orders kept for "My Orders"
 
 KFC_TARKWA_DELIVERY_PRICES = {
     "tarkwa central": 30,
@@ -132,8 +360,16 @@ KFC_TARKWA_DELIVERY_PRICES = {
     "aboso": 30,
     "other": 30
 }
+# Named areas to match against the typed location; "other" is the fallback
+KFC_TARKWA_AREA_FEES = tuple((loc, fee) for loc, fee in KFC_TARKWA_DELIVERY_PRICES.items() if loc != "other")
 
-memory_sessions = {}
+# In-memory fallback store: LRU-capped and idle sessions expire after SESSION_TTL
+memory_sessions = TTLCache(maxsize=MAX_MEMORY_SESSIONS, ttl=SESSION_TTL)
+memory_sessions_lock = threading.Lock()
+# Order history lives apart from the session so "My Orders" survives SESSION_TTL;
+# it never expires on time, only the least recently used callers are evicted
+memory_order_history = LRUCache(maxsize=MAX_MEMORY_SESSIONS)
+memory_order_history_lock = threading.Lock()
 
 GAS_SIZES = [("3kg", 20), ("6kg", 30), ("12.5kg", 50)]
 
@@ -144,72 +380,201 @@ CUSTOM_ORDER_MENUS = [
     "Other"
 ]
 
+# Menus and valid choices are static, so build them once at import
+CATEGORY_MENU_STR = "\n".join(f"{i+1}. {cat}" for i, cat in enumerate(CATEGORIES))
+CATEGORY_CHOICES = {str(i+1) for i in range(len(CATEGORIES))}
+ITEM_MENU_STRS = {
+    cat: "\n".join(f"{i+1}. {m[0]} - GHS {m[1]}" for i, m in enumerate(menu))
+    for cat, menu in MENUS.items()
+}
+ITEM_CHOICES = {cat: {str(i+1) for i in range(len(menu))} for cat, menu in MENUS.items()}
+GAS_SIZE_MENU_STR = "\n".join(f"{i+1}. {s[0]} (min GHS {s[1]})" for i, s in enumerate(GAS_SIZES))
+GAS_SIZE_CHOICES = {str(i+1) for i in range(len(GAS_SIZES))}
+CUSTOM_ORDER_MENU_STR = "\n".join(f"{i+1}. {opt}" for i, opt in enumerate(CUSTOM_ORDER_MENUS))
+CUSTOM_ORDER_CHOICES = {str(i+1) for i in range(len(CUSTOM_ORDER_MENUS))}
+
+# Full menu screens, so handlers return a ready string instead of formatting one
+MAIN_CATEGORY_MENU_MSG = f"Select Vendor:\n{CATEGORY_MENU_STR}\n#. Back"
+CATEGORY_MENU_MSG = f"Select Vendor:\n{CATEGORY_MENU_STR}\n#. Back:"
+ITEM_MENU_MSGS = {cat: f"{cat} Menu:\n{menu_str}\n#. Back:" for cat, menu_str in ITEM_MENU_STRS.items()}
+GAS_SIZE_MENU_MSG = f"Select gas cylinder size:\n{GAS_SIZE_MENU_STR}\n#. Back"
+CUSTOM_ORDER_MENU_MSG = f"Select a custom order type:\n{CUSTOM_ORDER_MENU_STR}\n#. Back"
+MAIN_MENU_MSG = (
+    "Welcome to FLAP Dish!\n1. Order Food\n2. Gas Filling\n3. Custom Order\n"
+    "4. My Orders\n5. Help\n6. Campus Sellers\n0. Exit"
+)
+INVALID_MAIN_MENU_MSG = "Invalid option.\n" + MAIN_MENU_MSG
+HELP_MSG = f"Call {SUPPORT_PHONE} for help.\n#. Back:"
+CART_MSG = "1. Add more\n2. Checkout\n#. Cancel:"
+DELIVERY_LOCATION_PROMPT = "Enter delivery location:\n#. Back"
+
+# Message templates, filled with a single str.format pass per request
+GAS_CONFIRM_TMPL = (
+    "{size} gas\nTop-up: GHS {fill_amount}\n"
+    "Location: {location}\n"
+    "Delivery Fee: GHS {delivery_fee}\n"
+    "Total: GHS {total}\n"
+    "1. Confirm\n2. Cancel"
+)
+ORDER_TMPL = (
+    "{items_line}\nDelivery: GHS {delivery_fee} service: GHS {extra_charge}\n"
+    "Location: {location}\nTotal: GHS {total}\n"
+    "Discount code?\n1. Yes\n2. No:"
+)
+FINAL_ORDER_TMPL = (
+    "{discount_msg}{items_line}\nDelivery: GHS {delivery_fee} Service: GHS {extra_charge}{discount}"
+    "\nLocation:{location}\nTotal: GHS {total}\n"
+    "1. Confirm\n2. Cancel"
+)
+CUSTOM_CONFIRM_TMPL = (
+    "Custom Order ({order_type}):\n{summary}...\n"
+    "Location:{location}\nDelivery: GHS{delivery_fee}\n"
+    "1. Confirm\n2. Cancel"
+)
+DELIVERY_NOTE_PROMPT = "Enter delivery note for rider (optional, max 100 chars). Or press 0 to skip:"
+SMS_NOTE_TMPL = "\nNote: {note}"
+CUSTOM_SMS_TMPL = "Your FLAP Dish custom order #{order_id} has been received! Please dial *415*1738# and pay GHS {total} to process your order. Thank you!{note}"
+CUSTOM_RESULT_TMPL = "Custom Order #{order_id} created!\nPlease dial *415*1738# and pay GHS {total} for delivery.\nThank you!"
+GAS_SMS_TMPL = "Your Gas Filling order #{order_id} received! Pay GHS {total} to *415*1738# to process your order.{note}"
+GAS_RESULT_TMPL = "Order #{order_id} created!\nPay GHS {total} to *415*1738# for processing.\nThank you!"
+CONFIRM_SMS_TMPL = "Your order #{order_id} has been received! Please dial *415*1738# and pay GHS {total} to process your order. Thank you!{note}"
+CONFIRM_RESULT_TMPL = "Order #{order_id} created!\nPlease dial *415*1738# and pay GHS {total} for order processing.\nThank you!"
+
+# (minute, formatted timestamp) -- the format only changes once a minute
+airtable_datetime_cache = (None, "")
+
 def get_airtable_datetime():
-    return datetime.now().strftime("%Y-%m-%d %H:%M")
+    global airtable_datetime_cache
+    minute = int(time.time()) // 60
+    cached_minute, formatted = airtable_datetime_cache
+    if minute != cached_minute:
+        formatted = datetime.fromtimestamp(minute * 60).strftime("%Y-%m-%d %H:%M")
+        airtable_datetime_cache = (minute, formatted)
+    return formatted
+
+NON_DIGIT_RE = re.compile(r'[^\d]')
+SANITIZE_TABLE = str.maketrans('', '', '<>"\'')
+MENU_INPUT_CHARS = frozenset("0123456789#*")
 
 def validate_phone_number(phone):
-    if not phone:
+    # A valid number has 12 digits, so anything shorter can't pass
+    if not phone or len(phone) < 12:
         return False
-    clean_phone = re.sub(r'[^\d]', '', phone)
-    pattern = r'^233[2-9]\d{8}$'
-    return bool(re.match(pattern, clean_phone))
+    # MSISDNs normally arrive already clean, so skip the regex for those;
+    # isdecimal() accepts exactly what \d does (isdigit() also lets superscripts through)
+    if len(phone) == 12 and phone.isdecimal():
+        return phone.startswith('233') and phone[3] in '23456789'
+    clean_phone = NON_DIGIT_RE.sub('', phone)
+    # Same as ^233[2-9]\d{8}$ -- clean_phone is already all digits
+    return len(clean_phone) == 12 and clean_phone.startswith('233') and clean_phone[3] in '23456789'
 
 def sanitize_input(text):
     if not text:
         return ""
-    return re.sub(r'[<>"\']', '', text.strip())[:200]
+    text = text.strip()
+    # Menu picks like "1" or "2" are most of the traffic and have nothing to strip
+    if text.isascii() and text.isalnum():
+        return text[:200]
+    return text.translate(SANITIZE_TABLE)[:200]
+
+def new_session():
+    return {
+        "state": "MAIN_MENU",
+        "cart": [],
+        "selected_category": None,
+        "selected_item": None,
+        "delivery_location": "",
+        "custom_order": "",
+        "custom_order_type": "",
+        "total": 0,
+        "session_id": secrets.token_hex(4),
+        "discount_code": None,
+        "discount_amount": 0,
+        "delivery_note": ""
+    }
 
 def get_session(msisdn):
-    if msisdn not in memory_sessions:
-        memory_sessions[msisdn] = {
-            "state": "MAIN_MENU",
-            "cart": [],
-            "selected_category": None,
-            "selected_item": None,
-            "delivery_location": "",
-            "custom_order": "",
-            "custom_order_type": "",
-            "total": 0,
-            "order_history": [],
-            "session_id": str(uuid.uuid4()),
-            "discount_code": None,
-            "discount_amount": 0,
-            "delivery_note": ""
-        }
+    if redis_client:
+        try:
+            raw = redis_client.get(f"ussd:{msisdn}")
+            session = orjson.loads(raw) if raw else new_session()
+            # Ensure delivery_note key is always present
+            session.setdefault("delivery_note", "")
+            return session
+        except Exception as e:
+            logger.error("Redis session read error: %s", e)
+    with memory_sessions_lock:
+        session = memory_sessions.get(msisdn)
+        if session is None:
+            session = memory_sessions[msisdn] = new_session()
     # Ensure delivery_note key is always present
-    if "delivery_note" not in memory_sessions[msisdn]:
-        memory_sessions[msisdn]["delivery_note"] = ""
-    return memory_sessions[msisdn]
+    session.setdefault("delivery_note", "")
+    return session
 
 def save_session(msisdn, session):
-    memory_sessions[msisdn] = session
+    if redis_client:
+        try:
+            # Sessions are plain dicts/lists, so they round-trip through JSON
+            redis_client.setex(f"ussd:{msisdn}", SESSION_TTL, orjson.dumps(session))
+            return
+        except Exception as e:
+            logger.error("Redis session write error: %s", e)
+    with memory_sessions_lock:
+        memory_sessions[msisdn] = session
+
+def get_order_history(msisdn):
+    if redis_client:
+        try:
+            raw = redis_client.get(f"ussd:orders:{msisdn}")
+            return orjson.loads(raw) if raw else []
+        except Exception as e:
+            logger.error("Redis order history read error: %s", e)
+    with memory_order_history_lock:
+        return memory_order_history.get(msisdn, [])
+
+def add_order_history(msisdn, entry):
+    # Only the most recent orders are shown, so only those are kept
+    orders = (get_order_history(msisdn) + [entry])[-MAX_ORDER_HISTORY:]
+    if redis_client:
+        try:
+            redis_client.setex(f"ussd:orders:{msisdn}", ORDER_HISTORY_TTL, orjson.dumps(orders))
+            return
+        except Exception as e:
+            logger.error("Redis order history write error: %s", e)
+    with memory_order_history_lock:
+        memory_order_history[msisdn] = orders
 
-def log_to_airtable_order(msisdn, userid, items, total, delivery_location, order_type, order_id, delivery_note=""):
+def log_to_airtable_order(msisdn, userid, items, total, delivery_location, order_type, order_id, delivery_note="", created_at=None):
     if not airtable_orders:
         return
+    record = {
+        "OrderID": order_id,
+        "MSISDN": msisdn,
+        "USERID": userid,
+        "Items": orjson.dumps(items).decode(),
+        "Total": total,
+        "DeliveryLocation": delivery_location,
+        "OrderType": order_type,
+        "Status": "Processing",
+        "CreatedAt": created_at or get_airtable_datetime(),
+        "DeliveryNote": delivery_note
+    }
     try:
-        airtable_orders.create({
-            "OrderID": order_id,
-            "MSISDN": msisdn,
-            "USERID": userid,
-            "Items": json.dumps(items),
-            "Total": total,
-            "DeliveryLocation": delivery_location,
-            "OrderType": order_type,
-            "Status": "Processing",
-            "CreatedAt": get_airtable_datetime(),
-            "DeliveryNote": delivery_note
-        })
-        logger.info(f"Order logged to Airtable: {msisdn} - {order_id}")
-    except Exception as e:
-        logger.error(f"Airtable order log error: {e}")
+        airtable_order_queue.put_nowait(record)
+    except queue.Full:
+        # Never drop an order: fall back to writing it inline
+        try:
+            airtable_orders.create(record)
+            logger.info("Order logged to Airtable: %s - %s", msisdn, order_id)
+        except Exception as e:
+            logger.error("Airtable order log error: %s - %s: %s", msisdn, order_id, e)
 
 def get_delivery_fee(session):
     vendor = session.get("selected_category", "")
-    location = session.get("delivery_location", "").strip().lower()
     if vendor == "KFC - Tarkwa":
-        for loc, fee in KFC_TARKWA_DELIVERY_PRICES.items():
-            if loc != "other" and loc in location:
+        location = session.get("delivery_location", "").strip().lower()
+        for loc, fee in KFC_TARKWA_AREA_FEES:
+            if loc in location:
                 return fee
         return KFC_TARKWA_DELIVERY_PRICES["other"]
     elif vendor:
@@ -219,133 +584,120 @@ def get_delivery_fee(session):
     else:
         return DEFAULT_DELIVERY_FEE
 
-def create_order(session, msisdn, order_type="regular", user_id=""):
-    order_id = str(uuid.uuid4())[:8].upper()
-    delivery_note = session.get("delivery_note", "")
+def price_cart(session, apply_discount=True):
+    # Food order pricing shared by the confirmation screens and create_order
+    items_total = 0
+    for item, qty, category in session["cart"]:
+        items_total += item[1] * qty
+    delivery_fee = get_delivery_fee(session)
+    total = items_total + delivery_fee + SERVICE_CHARGE
+    if apply_discount and session.get("discount_amount"):
+        total = max(total - session["discount_amount"], 0)
+    return delivery_fee, total
+
+def cart_summary_line(cart):
+    lines = [f"{qty}x{item[0]}" for item, qty, category in cart[:2]]
+    if len(cart) > 2:
+        lines.append(f"+{len(cart)-2} more")
+    return ", ".join(lines)
+
+def build_order_items(session, order_type):
+    # Only needed for the Airtable row
     if order_type == "custom":
-        items = [{
+        return [{
             "name": f"Custom Order ({session.get('custom_order_type', 'Other')})",
             "description": session["custom_order"],
             "price": CATEGORY_DELIVERY_FEES.get("Custom", 30),
             "quantity": 1,
             "category": "Custom"
         }]
-        total = CATEGORY_DELIVERY_FEES.get("Custom", 30)
     elif order_type == "gas_filling":
-        gas_size = session.get("selected_gas", ("Unknown", 0))
-        gas_amount = session.get("gas_fill_amount", 0)
-        delivery_fee = GAS_DELIVERY_FEE
-        items = [{
-            "name": f"Gas Filling - {gas_size[0]}",
-            "price": gas_amount,
+        return [{
+            "name": f"Gas Filling - {session.get('selected_gas', ('Unknown', 0))[0]}",
+            "price": session.get("gas_fill_amount", 0),
             "quantity": 1,
             "category": "Gas Filling"
         }]
-        total = gas_amount + delivery_fee
+    return [{
+        "name": item[0],
+        "price": item[1],
+        "quantity": qty,
+        "category": category
+    } for item, qty, category in session["cart"]]
+
+def create_order(session, msisdn, order_type="regular", user_id=""):
+    order_id = secrets.token_hex(4).upper()
+    delivery_note = session.get("delivery_note", "")
+    delivery_location = session.get("delivery_location", "")
+    # One timestamp for both the Airtable row and the session's order history
+    created_at = get_airtable_datetime()
+    if order_type == "custom":
+        total = CATEGORY_DELIVERY_FEES.get("Custom", 30)
+    elif order_type == "gas_filling":
+        total = session.get("gas_fill_amount", 0) + GAS_DELIVERY_FEE
+        delivery_location = session.get("gas_location", "")
+    else:
+        _, total = price_cart(session)
+
+    if airtable_orders:
         log_to_airtable_order(
-            msisdn, user_id, items, total,
-            session.get("gas_location", ""),
+            msisdn, user_id, build_order_items(session, order_type), total,
+            delivery_location,
             order_type, order_id,
-            delivery_note
+            delivery_note, created_at
         )
-        session["order_history"].append({
-            "order_id": order_id,
-            "total": total,
-            "order_type": order_type,
-            "created_at": get_airtable_datetime()
-        })
-        return order_id, total
-    else:
-        items = []
-        items_total = 0
-        for item, qty, category in session["cart"]:
-            items.append({
-                "name": item[0],
-                "price": item[1],
-                "quantity": qty,
-                "category": category
-            })
-            items_total += item[1] * qty
-        delivery_fee = get_delivery_fee(session)
-        extra_charge = 4
-        total = items_total + delivery_fee + extra_charge
-        if session.get("discount_amount"):
-            total -= session["discount_amount"]
-            if total < 0:
-                total = 0
-
-    log_to_airtable_order(
-        msisdn, user_id, items, total,
-        session.get("delivery_location", ""),
-        order_type, order_id,
-        delivery_note
-    )
 
-    session["order_history"].append({
+    add_order_history(msisdn, {
         "order_id": order_id,
         "total": total,
         "order_type": order_type,
-        "created_at": get_airtable_datetime()
+        "created_at": created_at
     })
     return order_id, total
 
+# Error bodies never change, so encode them once
+INVALID_REQUEST_BODY = orjson.dumps({"error": "Invalid request"})
+INTERNAL_ERROR_BODY = orjson.dumps({"error": "Internal error"})
+
+def json_response(body, status=200):
+    # body is already-encoded JSON (orjson bytes or a prebuilt string)
+    return app.response_class(body, status=status, mimetype="application/json")
+
 @app.route("/", methods=["POST"])
 @app.route("/ussd", methods=["POST"])
+@limiter.limit("30/minute;5/second")
 def ussd_handler():
     try:
-        data = request.get_json()
+        data = get_ussd_payload()
         if not data:
-            return jsonify({"error": "Invalid request"}), 400
+            return json_response(INVALID_REQUEST_BODY, 400)
         msisdn = data.get("MSISDN")
-        input_text = sanitize_input(data.get("USERDATA", ""))
+        raw_input = data.get("USERDATA", "")
+        # Menu keypresses ("1", "#", "*") need no cleaning
+        if raw_input and len(raw_input) <= 3 and MENU_INPUT_CHARS.issuperset(raw_input):
+            input_text = raw_input
+        else:
+            input_text = sanitize_input(raw_input)
         user_id = data.get("USERID", "NALOTest")
-        logger.info(f"Received MSISDN: '{msisdn}' (type: {type(msisdn)})")
-        logger.info(f"Full request data: {data}")
+        g.ussd_input = input_text
+        logger.info("Received MSISDN: '%s' (type: %s)", msisdn, type(msisdn))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Full request data: %s", data)
 
         if not msisdn:
             logger.error("No MSISDN provided in request")
             return ussd_response(user_id, "unknown", "No phone number provided.", False)
         if not validate_phone_number(msisdn):
-            logger.error(f"Phone validation failed for: '{msisdn}'")
+            logger.error("Phone validation failed for: '%s'", msisdn)
             return ussd_response(user_id, msisdn, f"Phone must start with 233. Got: {msisdn}", False)
         session = get_session(msisdn)
         state = session["state"]
-        logger.info(f"USSD: {msisdn}, State: {state}, Input: '{input_text}'")
-        log_to_firebase(msisdn, user_id, input_text, True, session['state'], session.get('session_id'))
-        if state == "MAIN_MENU":
-            response = handle_main_menu(input_text, session, user_id, msisdn)
-        elif state == "GAS_SIZE":
-            response = handle_gas_size(input_text, session, user_id, msisdn)
-        elif state == "GAS_AMOUNT":
-            response = handle_gas_amount(input_text, session, user_id, msisdn)
-        elif state == "GAS_LOCATION":
-            response = handle_gas_location(input_text, session, user_id, msisdn)
-        elif state == "GAS_CONFIRM":
-            response = handle_gas_confirm(input_text, session, user_id, msisdn)
-        elif state == "CATEGORY":
-            response = handle_category(input_text, session, user_id, msisdn)
-        elif state == "ITEM":
-            response = handle_item(input_text, session, user_id, msisdn)
-        elif state == "QTY":
-            response = handle_quantity(input_text, session, user_id, msisdn)
-        elif state == "CART":
-            response = handle_cart(input_text, session, user_id, msisdn)
-        elif state == "CUSTOM_ORDER_TYPE":
-            response = handle_custom_order_type(input_text, session, user_id, msisdn)
-        elif state == "CUSTOM_ORDER":
-            response = handle_custom_order(input_text, session, user_id, msisdn)
-        elif state == "DELIVERY":
-            response = handle_delivery(input_text, session, user_id, msisdn)
-        elif state == "DISCOUNT_ASK":
-            response = handle_discount_ask(input_text, session, user_id, msisdn)
-        elif state == "DISCOUNT_ENTER":
-            response = handle_discount_enter(input_text, session, user_id, msisdn)
-        elif state == "CONFIRM":
-            response = handle_confirm(input_text, session, user_id, msisdn)
-        elif state == "CUSTOM_CONFIRM":
-            response = handle_custom_confirm(input_text, session, user_id, msisdn)
-        elif state == "DELIVERY_NOTE":
-            response = handle_delivery_note(input_text, session, user_id, msisdn)
+        logger.info("USSD: %s, State: %s, Input: '%s'", msisdn, state, input_text)
+        g.ussd_state = state
+        g.ussd_session_id = session.get('session_id')
+        handler = STATE_HANDLERS.get(state)
+        if handler:
+            response = handler(input_text, session, user_id, msisdn)
         else:
             session["state"] = "MAIN_MENU"
             response = handle_main_menu("", session, user_id, msisdn)
@@ -353,56 +705,53 @@ def ussd_handler():
         return response
     except Exception as e:
         logger.error(f"USSD error: {e}", exc_info=True)
-        return jsonify({"error": "Internal error"}), 500
+        return json_response(INTERNAL_ERROR_BODY, 500)
 
 def handle_main_menu(input_text, session, user_id, msisdn):
-    msg = "Welcome to FLAP Dish!\n1. Order Food\n2. Gas Filling\n3. Custom Order\n4. My Orders\n5. Help\n6. Campus Sellers\n0. Exit"
+    msg = MAIN_MENU_MSG
     if input_text == "" or input_text.startswith("*") or input_text == "#":
         pass
     elif input_text == "1":
         session["state"] = "CATEGORY"
-        cat_menu = "\n".join([f"{i+1}. {cat}" for i, cat in enumerate(CATEGORIES)])
-        msg = f"Select Vendor:\n{cat_menu}\n#. Back"
+        msg = MAIN_CATEGORY_MENU_MSG
     elif input_text == "2":
         session["state"] = "GAS_SIZE"
-        gas_size_menu = "\n".join([f"{i+1}. {s[0]} (min GHS {s[1]})" for i, s in enumerate(GAS_SIZES)])
-        msg = f"Select gas cylinder size:\n{gas_size_menu}\n#. Back"
+        msg = GAS_SIZE_MENU_MSG
     elif input_text == "3":
         session["state"] = "CUSTOM_ORDER_TYPE"
-        custom_menu = "\n".join([f"{i+1}. {opt}" for i, opt in enumerate(CUSTOM_ORDER_MENUS)])
-        msg = f"Select a custom order type:\n{custom_menu}\n#. Back"
+        msg = CUSTOM_ORDER_MENU_MSG
     elif input_text == "4":
-        orders = session.get("order_history", [])
+        orders = get_order_history(msisdn)
         if orders:
-            recent = orders[-3:]
-            order_lines = [f"{o['order_id']}: GHS {o['total']} ({o.get('order_type', 'regular')})" for o in recent]
-            msg = "Recent Orders:\n" + "\n".join(order_lines) + "\n#. Back:"
+            msg = "\n".join([
+                "Recent Orders:",
+                *(f"{o['order_id']}: GHS {o['total']} ({o.get('order_type', 'regular')})" for o in orders[-MAX_ORDER_HISTORY:]),
+                "#. Back:"
+            ])
         else:
             msg = "No orders yet.\n#. Back:"
     elif input_text == "5":
-        msg = f"Call {SUPPORT_PHONE} for help.\n#. Back:"
+        msg = HELP_MSG
     elif input_text == "6":
         msg = "Coming Soon! \n#. Back:"
     elif input_text == "0":
         msg = "Thank you for using FLAP Dish!"
         return ussd_response(user_id, msisdn, msg, False)
     else:
-        msg = "Invalid option.\n" + msg
+        msg = INVALID_MAIN_MENU_MSG
     return ussd_response(user_id, msisdn, msg, True)
 
 def handle_gas_size(input_text, session, user_id, msisdn):
     if input_text == "#":
         session["state"] = "MAIN_MENU"
         return handle_main_menu("", session, user_id, msisdn)
-    idxs = [str(i+1) for i in range(len(GAS_SIZES))]
-    if input_text in idxs:
+    if input_text in GAS_SIZE_CHOICES:
         selected = GAS_SIZES[int(input_text)-1]
         session["selected_gas"] = selected
         session["state"] = "GAS_AMOUNT"
         msg = f"{selected[0]} selected. How much do you want to fill? (in cedis)\n#. Back"
         return ussd_response(user_id, msisdn, msg, True)
-    gas_size_menu = "\n".join([f"{i+1}. {s[0]} (min GHS {s[1]})" for i, s in enumerate(GAS_SIZES)])
-    msg = f"Select gas cylinder size:\n{gas_size_menu}\n#. Back"
+    msg = GAS_SIZE_MENU_MSG
     return ussd_response(user_id, msisdn, msg, True)
 
 def handle_gas_amount(input_text, session, user_id, msisdn):
@@ -415,7 +764,7 @@ def handle_gas_amount(input_text, session, user_id, msisdn):
         if amount >= min_amount:
             session["gas_fill_amount"] = amount
             session["state"] = "GAS_LOCATION"
-            msg = "Enter delivery location:\n#. Back"
+            msg = DELIVERY_LOCATION_PROMPT
             return ussd_response(user_id, msisdn, msg, True)
         else:
             msg = f"Minimum for {session['selected_gas'][0]} is GHS {min_amount}. Enter amount (in cedis):\n#. Back"
@@ -442,15 +791,17 @@ def show_gas_confirmation(session, user_id, msisdn):
     delivery_fee = GAS_DELIVERY_FEE
     total = fill_amount + delivery_fee
     session["total"] = total
-    msg = (
-        f"{size} gas\nTop-up: GHS {fill_amount}\n"
-        f"Location: {location}\n"
-        f"Delivery Fee: GHS {delivery_fee}\n"
-        f"Total: GHS {total}\n"
-        "1. Confirm\n2. Cancel"
+    msg = GAS_CONFIRM_TMPL.format(
+        size=size, fill_amount=fill_amount, location=location,
+        delivery_fee=delivery_fee, total=total
     )
     return ussd_response(user_id, msisdn, msg, True)
 
+def ask_delivery_note(session, user_id, msisdn):
+    # Shared last step of every checkout (food, gas, custom) before the order is placed
+    session["state"] = "DELIVERY_NOTE"
+    return ussd_response(user_id, msisdn, DELIVERY_NOTE_PROMPT, True)
+
 def handle_gas_confirm(input_text, session, user_id, msisdn):
     if input_text == "2":
         session.pop("selected_gas", None)
@@ -459,41 +810,33 @@ def handle_gas_confirm(input_text, session, user_id, msisdn):
         session["state"] = "MAIN_MENU"
         return handle_main_menu("", session, user_id, msisdn)
     elif input_text == "1":
-        session["state"] = "DELIVERY_NOTE"
-        msg = "Enter delivery note for rider (optional, max 100 chars). Or press 0 to skip:"
-        return ussd_response(user_id, msisdn, msg, True)
+        return ask_delivery_note(session, user_id, msisdn)
     return show_gas_confirmation(session, user_id, msisdn)
 
 def handle_custom_order_type(input_text, session, user_id, msisdn):
     if input_text == "#":
         session["state"] = "MAIN_MENU"
         return handle_main_menu("", session, user_id, msisdn)
-    idxs = [str(i+1) for i in range(len(CUSTOM_ORDER_MENUS))]
-    if input_text in idxs:
+    if input_text in CUSTOM_ORDER_CHOICES:
         selected_type = CUSTOM_ORDER_MENUS[int(input_text)-1]
         session["custom_order_type"] = selected_type
         session["state"] = "CUSTOM_ORDER"
         msg = f"Enter details for '{selected_type}':\n#. Back"
         return ussd_response(user_id, msisdn, msg, True)
-    custom_menu = "\n".join([f"{i+1}. {opt}" for i, opt in enumerate(CUSTOM_ORDER_MENUS)])
-    msg = f"Select a custom order type:\n{custom_menu}\n#. Back"
+    msg = CUSTOM_ORDER_MENU_MSG
     return ussd_response(user_id, msisdn, msg, True)
 
 def handle_category(input_text, session, user_id, msisdn):
     if input_text == "#":
         session["state"] = "MAIN_MENU"
         return handle_main_menu("", session, user_id, msisdn)
-    idxs = [str(i+1) for i in range(len(CATEGORIES))]
-    if input_text in idxs:
+    if input_text in CATEGORY_CHOICES:
         cat = CATEGORIES[int(input_text)-1]
         session["selected_category"] = cat
         session["state"] = "ITEM"
-        menu = MENUS[cat]
-        menu_str = "\n".join([f"{i+1}. {m[0]} - GHS {m[1]}" for i, m in enumerate(menu)])
-        msg = f"{cat} Menu:\n{menu_str}\n#. Back:"
+        msg = ITEM_MENU_MSGS[cat]
         return ussd_response(user_id, msisdn, msg, True)
-    cat_menu = "\n".join([f"{i+1}. {cat}" for i, cat in enumerate(CATEGORIES)])
-    msg = f"Select Vendor:\n{cat_menu}\n#. Back:"
+    msg = CATEGORY_MENU_MSG
     return ussd_response(user_id, msisdn, msg, True)
 
 def handle_item(input_text, session, user_id, msisdn):
@@ -501,16 +844,13 @@ def handle_item(input_text, session, user_id, msisdn):
         session["state"] = "CATEGORY"
         return handle_category("", session, user_id, msisdn)
     cat = session["selected_category"]
-    menu = MENUS[cat]
-    idxs = [str(i+1) for i in range(len(menu))]
-    if input_text in idxs:
-        item = menu[int(input_text)-1]
+    if input_text in ITEM_CHOICES[cat]:
+        item = MENUS[cat][int(input_text)-1]
         session["selected_item"] = item
         session["state"] = "QTY"
         msg = f"{item[0]} selected.\nEnter quantity (1-20):\n#. Back"
         return ussd_response(user_id, msisdn, msg, True)
-    menu_str = "\n".join([f"{i+1}. {m[0]} - GHS {m[1]}" for i, m in enumerate(menu)])
-    msg = f"{cat} Menu:\n{menu_str}\n#. Back:"
+    msg = ITEM_MENU_MSGS[cat]
     return ussd_response(user_id, msisdn, msg, True)
 
 def handle_quantity(input_text, session, user_id, msisdn):
@@ -524,7 +864,7 @@ def handle_quantity(input_text, session, user_id, msisdn):
         if 1 <= qty <= 20:
             session["cart"].append((item, qty, category))
             session["state"] = "CART"
-            msg = f"{qty} x {item[0]} added to cart.\n1. Add more\n2. Checkout\n#. Cancel:"
+            msg = f"{qty} x {item[0]} added to cart.\n{CART_MSG}"
             return ussd_response(user_id, msisdn, msg, True)
     except ValueError:
         pass
@@ -537,13 +877,13 @@ def handle_cart(input_text, session, user_id, msisdn):
         return handle_category("", session, user_id, msisdn)
     elif input_text == "2":
         session["state"] = "DELIVERY"
-        msg = "Enter delivery location:\n#. Back"
+        msg = DELIVERY_LOCATION_PROMPT
         return ussd_response(user_id, msisdn, msg, True)
     elif input_text == "#":
         session["cart"] = []
         session["state"] = "MAIN_MENU"
         return handle_main_menu("", session, user_id, msisdn)
-    msg = "1. Add more\n2. Checkout\n#. Cancel:"
+    msg = CART_MSG
     return ussd_response(user_id, msisdn, msg, True)
 
 def handle_delivery(input_text, session, user_id, msisdn):
@@ -561,23 +901,11 @@ def handle_delivery(input_text, session, user_id, msisdn):
     return ussd_response(user_id, msisdn, msg, True)
 
 def show_confirmation(session, user_id, msisdn):
-    cart = session["cart"]
-    delivery_fee = get_delivery_fee(session)
-    extra_charge = 4
-    items_total = sum(item[1]*qty for item, qty, cat in cart)
-    total = items_total + delivery_fee + extra_charge
+    delivery_fee, total = price_cart(session, apply_discount=False)
     session["total"] = total
-    lines = []
-    for idx, (item, qty, cat) in enumerate(cart):
-        if idx < 2:
-            lines.append(f"{qty}x{item[0]}")
-    if len(cart) > 2:
-        lines.append(f"+{len(cart)-2} more")
-    items_line = ", ".join(lines)
-    msg = (
-        f"{items_line}\nDelivery: GHS {delivery_fee} service: GHS {extra_charge}\n"
-        f"Location: {session['delivery_location']}\nTotal: GHS {total}\n"
-        "Discount code?\n1. Yes\n2. No:"
+    msg = ORDER_TMPL.format(
+        items_line=cart_summary_line(session["cart"]), delivery_fee=delivery_fee, extra_charge=SERVICE_CHARGE,
+        location=session['delivery_location'], total=total
     )
     session["state"] = "DISCOUNT_ASK"
     return ussd_response(user_id, msisdn, msg, True)
@@ -615,34 +943,13 @@ def handle_discount_enter(input_text, session, user_id, msisdn):
         return ussd_response(user_id, msisdn, msg, True)
 
 def show_final_confirmation(session, user_id, msisdn, discount_applied_msg=None):
-    cart = session["cart"]
-    delivery_fee = get_delivery_fee(session)
-    extra_charge = 4
-    items_total = sum(item[1]*qty for item, qty, cat in cart)
-    total = items_total + delivery_fee + extra_charge
-    if session.get("discount_amount"):
-        total -= session["discount_amount"]
-        if total < 0:
-            total = 0
+    delivery_fee, total = price_cart(session)
     session["total"] = total
-    lines = []
-    for idx, (item, qty, cat) in enumerate(cart):
-        if idx < 2:
-            lines.append(f"{qty}x{item[0]}")
-    if len(cart) > 2:
-        lines.append(f"+{len(cart)-2} more")
-    items_line = ", ".join(lines)
-    msg = ""
-    if discount_applied_msg:
-        msg += discount_applied_msg + "\n"
-    msg += (
-        f"{items_line}\nDelivery: GHS {delivery_fee} Service: GHS {extra_charge}"
-    )
-    if session.get("discount_code"):
-        msg += f" Discount:-{session['discount_amount']}"
-    msg += (
-        f"\nLocation:{session['delivery_location']}\nTotal: GHS {total}\n"
-        "1. Confirm\n2. Cancel"
+    msg = FINAL_ORDER_TMPL.format(
+        discount_msg=discount_applied_msg + "\n" if discount_applied_msg else "",
+        items_line=cart_summary_line(session["cart"]), delivery_fee=delivery_fee, extra_charge=SERVICE_CHARGE,
+        discount=f" Discount:-{session['discount_amount']}" if session.get("discount_code") else "",
+        location=session['delivery_location'], total=total
     )
     return ussd_response(user_id, msisdn, msg, True)
 
@@ -655,9 +962,7 @@ def handle_confirm(input_text, session, user_id, msisdn):
         session["delivery_note"] = ""
         return handle_main_menu("", session, user_id, msisdn)
     elif input_text == "1":
-        session["state"] = "DELIVERY_NOTE"
-        msg = "Enter delivery note for rider (optional, max 100 chars). Or press 0 to skip:"
-        return ussd_response(user_id, msisdn, msg, True)
+        return ask_delivery_note(session, user_id, msisdn)
     return show_final_confirmation(session, user_id, msisdn)
 
 def handle_custom_order(input_text, session, user_id, msisdn):
@@ -667,7 +972,7 @@ def handle_custom_order(input_text, session, user_id, msisdn):
     if input_text and len(input_text.strip()) >= 10:
         session["custom_order"] = input_text.strip()
         session["state"] = "DELIVERY"
-        msg = "Enter delivery location:\n#. Back"
+        msg = DELIVERY_LOCATION_PROMPT
         return ussd_response(user_id, msisdn, msg, True)
     msg = "Enter custom order details (min 10 chars):\n#. Back"
     return ussd_response(user_id, msisdn, msg, True)
@@ -680,50 +985,42 @@ def handle_custom_confirm(input_text, session, user_id, msisdn):
         session["delivery_note"] = ""
         return handle_main_menu("", session, user_id, msisdn)
     elif input_text == "1":
-        session["state"] = "DELIVERY_NOTE"
-        msg = "Enter delivery note for rider (optional, max 100 chars). Or press 0 to skip:"
-        return ussd_response(user_id, msisdn, msg, True)
+        return ask_delivery_note(session, user_id, msisdn)
     return show_custom_confirmation(session, user_id, msisdn)
 
 def show_custom_confirmation(session, user_id, msisdn):
     summary = session['custom_order'][:40]
     order_type = session.get("custom_order_type", "Other")
     delivery_fee = CATEGORY_DELIVERY_FEES.get("Custom", 30)
-    msg = (
-        f"Custom Order ({order_type}):\n{summary}...\n"
-        f"Location:{session['delivery_location']}\nDelivery: GHS{delivery_fee}\n"
-        "1. Confirm\n2. Cancel"
+    msg = CUSTOM_CONFIRM_TMPL.format(
+        order_type=order_type, summary=summary,
+        location=session['delivery_location'], delivery_fee=delivery_fee
     )
     return ussd_response(user_id, msisdn, msg, True)
 
 def handle_delivery_note(input_text, session, user_id, msisdn):
     note = input_text.strip()
-    if note == "0" or not note:
-        session["delivery_note"] = ""
-    else:
-        session["delivery_note"] = note[:100]
+    delivery_note = "" if note == "0" or not note else note[:100]
+    session["delivery_note"] = delivery_note
     # Determine order type and finalize order
-    msg = ""
+    note = SMS_NOTE_TMPL.format(note=delivery_note) if delivery_note else ""
     if session.get("custom_order"):
         order_id, total = create_order(session, msisdn, "custom", user_id)
-        sms_msg = f"Your FLAP Dish custom order #{order_id} has been received! Please dial *415*1738# and pay GHS {total} to process your order. Thank you!\nNote: {session['delivery_note']}" if session['delivery_note'] else f"Your FLAP Dish custom order #{order_id} has been received! Please dial *415*1738# and pay GHS {total} to process your order. Thank you!"
-        send_sms_ghana(msisdn, sms_msg)
-        msg = f"Custom Order #{order_id} created!\nPlease dial *415*1738# and pay GHS {total} for delivery.\nThank you!"
+        SMS_EXECUTOR.submit(send_sms_ghana, msisdn, CUSTOM_SMS_TMPL.format(order_id=order_id, total=total, note=note))
+        msg = CUSTOM_RESULT_TMPL.format(order_id=order_id, total=total)
         session["custom_order"] = ""
         session["custom_order_type"] = ""
     elif session.get("gas_fill_amount"):
         order_id, total = create_order(session, msisdn, "gas_filling", user_id)
-        sms_msg = f"Your Gas Filling order #{order_id} received! Pay GHS {total} to *415*1738# to process your order.\nNote: {session['delivery_note']}" if session['delivery_note'] else f"Your Gas Filling order #{order_id} received! Pay GHS {total} to *415*1738# to process your order."
-        send_sms_ghana(msisdn, sms_msg)
-        msg = f"Order #{order_id} created!\nPay GHS {total} to *415*1738# for processing.\nThank you!"
+        SMS_EXECUTOR.submit(send_sms_ghana, msisdn, GAS_SMS_TMPL.format(order_id=order_id, total=total, note=note))
+        msg = GAS_RESULT_TMPL.format(order_id=order_id, total=total)
         session.pop("selected_gas", None)
         session.pop("gas_fill_amount", None)
         session.pop("gas_location", None)
     else:
         order_id, total = create_order(session, msisdn, "regular", user_id)
-        sms_msg = f"Your order #{order_id} has been received! Please dial *415*1738# and pay GHS {total} to process your order. Thank you!\nNote: {session['delivery_note']}" if session['delivery_note'] else f"Your order #{order_id} has been received! Please dial *415*1738# and pay GHS {total} to process your order. Thank you!"
-        send_sms_ghana(msisdn, sms_msg)
-        msg = f"Order #{order_id} created!\nPlease dial *415*1738# and pay GHS {total} for order processing.\nThank you!"
+        SMS_EXECUTOR.submit(send_sms_ghana, msisdn, CONFIRM_SMS_TMPL.format(order_id=order_id, total=total, note=note))
+        msg = CONFIRM_RESULT_TMPL.format(order_id=order_id, total=total)
         session["cart"] = []
         session["discount_code"] = None
         session["discount_amount"] = 0
@@ -731,26 +1028,66 @@ def handle_delivery_note(input_text, session, user_id, msisdn):
     session["state"] = "MAIN_MENU"
     return ussd_response(user_id, msisdn, msg, False)
 
+STATE_HANDLERS = {
+    "MAIN_MENU": handle_main_menu,
+    "GAS_SIZE": handle_gas_size,
+    "GAS_AMOUNT": handle_gas_amount,
+    "GAS_LOCATION": handle_gas_location,
+    "GAS_CONFIRM": handle_gas_confirm,
+    "CATEGORY": handle_category,
+    "ITEM": handle_item,
+    "QTY": handle_quantity,
+    "CART": handle_cart,
+    "CUSTOM_ORDER_TYPE": handle_custom_order_type,
+    "CUSTOM_ORDER": handle_custom_order,
+    "DELIVERY": handle_delivery,
+    "DISCOUNT_ASK": handle_discount_ask,
+    "DISCOUNT_ENTER": handle_discount_enter,
+    "CONFIRM": handle_confirm,
+    "CUSTOM_CONFIRM": handle_custom_confirm,
+    "DELIVERY_NOTE": handle_delivery_note
+}
+
 def ussd_response(userid, msisdn, msg, continue_session=True):
     truncated_msg = msg[:160]
-    log_to_firebase(msisdn, userid, truncated_msg, continue_session)
-    logger.info(f"Response to {msisdn}: {truncated_msg[:50]}...")
-    return jsonify({
+    log_to_firebase(
+        msisdn, userid, g.get("ussd_input", ""), truncated_msg, continue_session,
+        g.get("ussd_state"), g.get("ussd_session_id")
+    )
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Response to %s: %s...", msisdn, truncated_msg[:50])
+    return json_response(orjson.dumps({
         "USERID": userid,
         "MSISDN": msisdn,
         "MSG": truncated_msg,
-        "MSGTYPE": bool(continue_session)
-    })
+        "MSGTYPE": continue_session
+    }))
+
+@app.errorhandler(429)
+def rate_limited(e):
+    # Answer in USSD form so the gateway shows the message and ends the session;
+    # the payload was already parsed (and cached on g) by rate_limit_key
+    data = get_ussd_payload()
+    if not isinstance(data, dict):
+        data = {}
+    return json_response(orjson.dumps({
+        "USERID": data.get("USERID", "NALOTest"),
+        "MSISDN": data.get("MSISDN"),
+        "MSG": RATE_LIMITED_MSG,
+        "MSGTYPE": False
+    }))
+
+# Only the timestamp changes between probes; it never needs JSON escaping
+HEALTH_TMPL = '{"status":"healthy","timestamp":"%%s","airtable":"%s"}' % (
+    "connected" if airtable_orders else "disabled"
+)
 
 @app.route("/health", methods=["GET"])
 def health_check():
-    return jsonify({
-        "status": "healthy",
-        "timestamp": get_airtable_datetime(),
-        "airtable": "connected" if airtable_orders else "disabled"
-    })
+    return json_response(HEALTH_TMPL % get_airtable_datetime())
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    # Local runs only; production goes through gunicorn (see gunicorn.conf.py)
     logger.info(f"Starting USSD Food Ordering on port {port}")
-    app.run(host="0.0.0.0", port=port, debug=True)
+    app.run(host="0.0.0.0", port=port, debug=os.environ.get("FLASK_DEBUG") == "1", threaded=True)
@@ -0,0 +1,8 @@
+# Production server settings, used by start.sh
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = "gevent"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", 1000))
+timeout = 120
@@ -1,2 +1,2 @@
 #!/usr/bin/env bash
-gunicorn --bind 0.0.0.0:$PORT --workers 2 --timeout 120 app:app
+gunicorn -c gunicorn.conf.py app:app
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Run against the in-process fallbacks only: no Redis, Airtable, Firebase or SMS
+os.environ["SUPPORT_PHONE"] = "0240000000"
+for key in ("REDIS_URL", "AIRTABLE_PAT", "AIRTABLE_BASE_ID", "FIREBASE_CREDENTIALS_JSON", "BULK_SMS_API_KEY"):
+    os.environ.pop(key, None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,282 @@
+import logging
+import queue
+import re
+import threading
+import time
+
+import pytest
+import requests
+
+import app as ussd
+
+ORDER_ID_RE = re.compile(r"#[0-9A-F]{8}")
+
+MAIN_MENU = (
+    "Welcome to FLAP Dish!\n1. Order Food\n2. Gas Filling\n3. Custom Order\n"
+    "4. My Orders\n5. Help\n6. Campus Sellers\n0. Exit"
+)
+NOTE_PROMPT = "Enter delivery note for rider (optional, max 100 chars). Or press 0 to skip:"
+
+
+class InlineExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"{status} error", response=response)
+
+
+class FakeOrdersTable:
+    def __init__(self, batch_error=None, fail_ids=()):
+        self.batch_error = batch_error
+        self.fail_ids = set(fail_ids)
+        self.batches = []
+        self.created = []
+
+    def batch_create(self, records):
+        if self.batch_error:
+            raise self.batch_error
+        self.batches.append(list(records))
+
+    def create(self, record):
+        if record["OrderID"] in self.fail_ids:
+            raise http_error(422)
+        self.created.append(record)
+
+
+@pytest.fixture
+def sms(monkeypatch):
+    sent = []
+    monkeypatch.setattr(ussd, "send_sms_ghana", lambda phone, msg: sent.append((phone, ORDER_ID_RE.sub("#ID", msg))))
+    monkeypatch.setattr(ussd, "SMS_EXECUTOR", InlineExecutor())
+    return sent
+
+
+@pytest.fixture
+def client(monkeypatch, sms):
+    monkeypatch.setattr(ussd, "redis_client", None)
+    monkeypatch.setattr(ussd, "airtable_orders", None)
+    monkeypatch.setattr(ussd.limiter, "enabled", False)
+    ussd.memory_sessions.clear()
+    ussd.memory_order_history.clear()
+    return ussd.app.test_client()
+
+
+def dial(client, msisdn, *inputs):
+    replies = []
+    for text in inputs:
+        resp = client.post("/ussd", json={"MSISDN": msisdn, "USERDATA": text, "USERID": "U"})
+        assert resp.status_code == 200
+        data = resp.get_json()
+        replies.append((ORDER_ID_RE.sub("#ID", data["MSG"]), data["MSGTYPE"]))
+    return replies
+
+
+def test_food_order_flow(client, sms):
+    replies = dial(
+        client, "233240000000",
+        "", "1", "1", "2", "3", "1", "2", "2", "2", "2", "Tarkwa central road", "1", "FLAP10", "1", "please call"
+    )
+    assert replies[0] == (MAIN_MENU, True)
+    assert replies[10] == (
+        "3xBanku & Tilapia, 2xFriedRice & Chicken\nDelivery: GHS 15 service: GHS 4\n"
+        "Location: Tarkwa central road\nTotal: GHS 209\nDiscount code?\n1. Yes\n2. No:", True
+    )
+    assert replies[12] == (
+        "Discount applied: GHS 7 off!\n3xBanku & Tilapia, 2xFriedRice & Chicken\n"
+        "Delivery: GHS 15 Service: GHS 4 Discount:-7\nLocation:Tarkwa central road\nTotal: GHS 202\n1.", True
+    )
+    assert replies[13] == (NOTE_PROMPT, True)
+    assert replies[14] == (
+        "Order #ID created!\nPlease dial *415*1738# and pay GHS 202 for order processing.\nThank you!", False
+    )
+    assert sms == [(
+        "233240000000",
+        "Your order #ID has been received! Please dial *415*1738# and pay GHS 202 to process your order. "
+        "Thank you!\nNote: please call"
+    )]
+
+
+def test_gas_order_flow(client, sms):
+    replies = dial(client, "233240000002", "", "2", "2", "10", "50", "Aboso", "1", "0")
+    assert replies[1] == (
+        "Select gas cylinder size:\n1. 3kg (min GHS 20)\n2. 6kg (min GHS 30)\n3. 12.5kg (min GHS 50)\n#. Back", True
+    )
+    assert replies[3] == ("Minimum for 6kg is GHS 30. Enter amount (in cedis):\n#. Back", True)
+    assert replies[5] == (
+        "6kg gas\nTop-up: GHS 50\nLocation: Aboso\nDelivery Fee: GHS 30\nTotal: GHS 80\n1. Confirm\n2. Cancel", True
+    )
+    assert replies[7] == ("Order #ID created!\nPay GHS 80 to *415*1738# for processing.\nThank you!", False)
+    assert sms == [
+        ("233240000002", "Your Gas Filling order #ID received! Pay GHS 80 to *415*1738# to process your order.")
+    ]
+
+
+def test_custom_order_flow(client, sms):
+    replies = dial(client, "233240000003", "", "3", "1", "buy some milk and bread", "Campus A", "1", "note")
+    assert replies[4] == (
+        "Custom Order (Grocery (Ransbet)):\nbuy some milk and bread...\nLocation:Campus A\n"
+        "Delivery: GHS30\n1. Confirm\n2. Cancel", True
+    )
+    assert replies[6] == (
+        "Custom Order #ID created!\nPlease dial *415*1738# and pay GHS 30 for delivery.\nThank you!", False
+    )
+    assert sms == [(
+        "233240000003",
+        "Your FLAP Dish custom order #ID has been received! Please dial *415*1738# and pay GHS 30 "
+        "to process your order. Thank you!\nNote: note"
+    )]
+
+
+def test_my_orders_lists_recent_orders_after_session_expiry(client):
+    assert dial(client, "233240000004", "", "4")[1] == ("No orders yet.\n#. Back:", True)
+    for amount in ("40", "50", "60", "70"):
+        dial(client, "233240000004", "", "2", "2", amount, "Aboso", "1", "0")
+    # The menu session expiring must not take "My Orders" with it
+    ussd.memory_sessions.clear()
+    msg, _ = dial(client, "233240000004", "", "4")[1]
+    assert re.sub(r"^[0-9A-F]{8}:", "ID:", msg, flags=re.M) == (
+        "Recent Orders:\nID: GHS 80 (gas_filling)\nID: GHS 90 (gas_filling)\n"
+        "ID: GHS 100 (gas_filling)\n#. Back:"
+    )
+
+
+@pytest.mark.parametrize("phone, valid", [
+    ("233241234567", True),
+    ("+233 24 123 4567", True),
+    ("233141234567", False),
+    ("2332412345678", False),
+    ("2332\u00b23456789", False),  # superscript two: isdigit() but not \d
+    ("", False),
+])
+def test_validate_phone_number_matches_baseline_regex(phone, valid):
+    assert ussd.validate_phone_number(phone) is valid
+    assert bool(re.match(r"^233[2-9]\d{8}$", re.sub(r"[^\d]", "", phone))) is valid
+
+
+def test_order_history_cap_of_one(client, monkeypatch):
+    monkeypatch.setattr(ussd, "MAX_ORDER_HISTORY", 1)
+    ussd.add_order_history("233240000005", {"order_id": "A"})
+    ussd.add_order_history("233240000005", {"order_id": "B"})
+    assert ussd.get_order_history("233240000005") == [{"order_id": "B"}]
+
+
+def test_rate_limited_caller_gets_ending_ussd_reply(client, monkeypatch):
+    monkeypatch.setattr(ussd.limiter, "enabled", True)
+    for _ in range(6):
+        resp = client.post("/ussd", json={"MSISDN": "233240000006", "USERDATA": "", "USERID": "U"})
+    assert resp.status_code == 200
+    assert resp.get_json() == {
+        "USERID": "U", "MSISDN": "233240000006", "MSG": ussd.RATE_LIMITED_MSG, "MSGTYPE": False
+    }
+
+
+def test_orders_are_batched_to_airtable(client, monkeypatch):
+    table = FakeOrdersTable()
+    order_queue = queue.Queue(maxsize=1000)
+    monkeypatch.setattr(ussd, "airtable_orders", table)
+    monkeypatch.setattr(ussd, "airtable_order_queue", order_queue)
+    dial(client, "233240000007", "", "2", "2", "50", "Aboso", "1", "0")
+    dial(client, "233240000007", "", "3", "1", "buy some milk and bread", "Campus A", "1", "0")
+    worker = threading.Thread(target=ussd.airtable_order_worker, daemon=True)
+    worker.start()
+    ussd.stop_batch_writer(worker, order_queue, ussd.AIRTABLE_BATCH_SIZE, ussd.write_airtable_batch)
+    assert not worker.is_alive()
+    assert len(table.batches) == 1
+    assert [r["OrderType"] for r in table.batches[0]] == ["gas_filling", "custom"]
+    assert table.batches[0][0]["Total"] == 80
+
+
+def test_rejected_batch_falls_back_to_single_creates(monkeypatch, caplog):
+    table = FakeOrdersTable(batch_error=http_error(422), fail_ids={"B"})
+    monkeypatch.setattr(ussd, "airtable_orders", table)
+    records = [{"OrderID": order_id, "MSISDN": "233240000008"} for order_id in "ABC"]
+    with caplog.at_level(logging.ERROR):
+        ussd.write_airtable_batch(records)
+    assert [r["OrderID"] for r in table.created] == ["A", "C"]
+    failed = [r.getMessage() for r in caplog.records if "233240000008 - B" in r.getMessage()]
+    assert len(failed) == 1
+
+
+@pytest.mark.parametrize("error", [requests.Timeout("read timed out"), requests.ConnectionError("reset"), http_error(503)])
+def test_ambiguous_batch_failure_is_logged_not_reposted(monkeypatch, caplog, error):
+    # Airtable may already have stored these, so re-creating them would duplicate orders
+    table = FakeOrdersTable(batch_error=error)
+    monkeypatch.setattr(ussd, "airtable_orders", table)
+    records = [{"OrderID": order_id, "MSISDN": "233240000008"} for order_id in "ABC"]
+    with caplog.at_level(logging.ERROR):
+        ussd.write_airtable_batch(records)
+    assert table.created == []
+    logged = [r.getMessage() for r in caplog.records]
+    for order_id in "ABC":
+        assert any(f"233240000008 - {order_id}" in msg for msg in logged)
+
+
+def test_full_queue_writes_order_inline(monkeypatch):
+    table = FakeOrdersTable()
+    full_queue = queue.Queue(maxsize=1)
+    full_queue.put({})
+    monkeypatch.setattr(ussd, "airtable_orders", table)
+    monkeypatch.setattr(ussd, "airtable_order_queue", full_queue)
+    ussd.log_to_airtable_order("233240000009", "U", [], 30, "Aboso", "custom", "ABCD1234")
+    assert [r["OrderID"] for r in table.created] == ["ABCD1234"]
+
+
+def test_stop_batch_writer_keeps_the_batch_in_flight():
+    written = []
+
+    def slow_write(records):
+        time.sleep(0.2)
+        written.extend(records)
+
+    record_queue = queue.Queue()
+    worker = threading.Thread(
+        target=ussd.run_batch_writer, args=(record_queue, 10, 0.05, slow_write), daemon=True
+    )
+    worker.start()
+    for i in range(25):
+        record_queue.put(i)
+    time.sleep(0.1)  # the worker is now holding a batch
+    ussd.stop_batch_writer(worker, record_queue, 10, slow_write)
+    assert sorted(written) == list(range(25))
+    assert not worker.is_alive()
+
+
+def sms_gateway_response(status, body):
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    return response
+
+
+@pytest.mark.parametrize("status, body, sent", [
+    (200, b"1000\n", True),
+    (200, b"1004", False),  # gateway-level failure code
+    (500, b"1000", False),  # non-2xx never counts as sent
+])
+def test_send_sms_ghana_uses_pooled_session(monkeypatch, status, body, sent):
+    calls = []
+
+    def fake_get(url, **kwargs):
+        calls.append((url, kwargs))
+        return sms_gateway_response(status, body)
+
+    monkeypatch.setattr(ussd, "BULK_SMS_API_KEY", "key")
+    monkeypatch.setattr(ussd, "BULK_SMS_SENDER_ID", "FLAPDish")
+    monkeypatch.setattr(ussd.http_session, "get", fake_get)
+    assert ussd.send_sms_ghana("233240000010", "hello") is sent
+    assert calls == [(ussd.SMS_API_URL, {
+        "params": {"key": "key", "to": "233240000010", "msg": "hello", "sender_id": "FLAPDish"},
+        "timeout": ussd.SMS_TIMEOUT,
+    })]
+
+
+def test_send_sms_ghana_reports_network_errors_as_failure(monkeypatch):
+    def fake_get(url, **kwargs):
+        raise requests.ConnectTimeout("gateway unreachable")
+
+    monkeypatch.setattr(ussd.http_session, "get", fake_get)
+    assert ussd.send_sms_ghana("233240000010", "hello") is False